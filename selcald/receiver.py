@@ -6,12 +6,11 @@ import sys
 import numpy as np
 from scipy import signal
 from scipy.io.wavfile import read
-from scipy.signal import butter, lfilter
-from math import log10
+from scipy.signal import butter
 from tones import TonesMonitor,TonesRecord,\
     note, printHeader, printFrame,\
     generateToneTemplate, DebugTonesFormat,\
-    TONES
+    ToneCorrelator, TONES
 
 from matplotlib import pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
@@ -32,14 +31,38 @@ def butter_bandpass(lowcut, highcut, fs, order=5):
     nyq = 0.5 * fs
     low = lowcut / nyq
     high = highcut / nyq
-    b, a = butter(order, [low, high], btype='band')
-    return b, a
-
-
-def butter_bandpass_filter(data, lowcut, highcut, fs, order=5):
-    b, a = butter_bandpass(lowcut, highcut, fs, order=order)
-    y = lfilter(b, a, data)
-    return y
+    sos = butter(order, [low, high], btype='band', output='sos')
+    # Samples are float32 through the pipeline, keep the sections in float32 too so sosfilt doesn't promote
+    return sos.astype(np.float32)
+
+# Polyphase FIR decimator (same anti-alias filter as signal.decimate(ftype='fir')) that keeps
+# the tail of the previous chunk, so the filter runs continuously across chunks of a stream
+class FirDecimator:
+
+    decimate:int
+    taps:np.ndarray
+    hist:np.ndarray
+    phase:int
+
+    def __init__(self, decimate:int):
+        self.decimate = decimate
+        self.taps = signal.firwin(20 * decimate + 1, 1.0 / decimate, window='hamming').astype(np.float32)
+        self.hist = np.zeros(len(self.taps) - 1, dtype=np.float32)
+        self.phase = 0
+
+    def process(self, data:np.ndarray):
+        ext = np.concatenate((self.hist, data))
+        self.hist = ext[len(ext) - len(self.hist):]
+
+        # Outputs fall on every decimate'th sample of the whole stream, phase is where the first one
+        # lands in this chunk, so chunks of any length give the same output as one long signal.
+        # History length is a multiple of decimate, so that output starts at a whole output index
+        y = signal.upfirdn(self.taps, ext[self.phase:], down=self.decimate)
+        beg = len(self.hist) // self.decimate
+        outputs = -(-(len(data) - self.phase) // self.decimate)
+        self.phase += outputs * self.decimate - len(data)
+
+        return y[beg:beg + outputs]
 
 def getDecimate(sig_rate: int):
     if (sig_rate not in SAMPLE_RATES):
@@ -79,11 +102,14 @@ def receiver(file_name):
 
     print('file: ', file_name, ' rate: ', inp_sig_rate, ' len: ', len(sig_noise))
 
+    # WAV data may be int16, int32 or float, float32 is plenty for the correlation and halves the memory traffic of float64
+    sig_noise = sig_noise.astype(np.float32, copy=False)
+
     decimate = getDecimate(inp_sig_rate)
     sig_rate = getNewSigRate(inp_sig_rate)
     
     if decimate > 1:
-        sig_noise = signal.decimate(sig_noise, decimate)
+        sig_noise = FirDecimator(decimate).process(sig_noise)
         
     print(f"Decimated by: [{decimate}] to new SigRate: [{sig_rate}] with a length after decimation: [{len(sig_noise)}]")
 
@@ -91,13 +117,11 @@ def receiver(file_name):
     frame_len = getFrameLength(inp_sig_rate)
     frames = int(len(sig_noise) / frame_len)
 
-    sig_noise = butter_bandpass_filter(sig_noise,
-                                       270,
-                                       1700,
-                                       sig_rate,
-                                       order=8)
+    sos = butter_bandpass(270, 1700, sig_rate, order=8)
+    sig_noise = signal.sosfilt(sos, sig_noise)
 
     template = generateToneTemplate(frame_len, sig_rate)
+    correlator = ToneCorrelator(template, frame_len)
 
     # See http://stackoverflow.com/questions/23507217/
     #         python-plotting-2d-data-on-to-3d-axes
@@ -119,19 +143,15 @@ def receiver(file_name):
         beg = frame * frame_len
         end = (frame+1) * frame_len
 
-        corr = np.zeros(len(TONES))
-
-        for tone in range(0, len(TONES)):
-            corr[tone] = log10(np.abs(signal.correlate(sig_noise[beg:end],
-                                                       template[tone],
-                                                       mode='same')).sum())
-            Z[frame, tone] = corr[tone]
+        corr = correlator.correlate(sig_noise[beg:end])
+        Z[frame] = corr
 
         tones_rec = TonesRecord(corr)
 
         printFrame(frame, tones_rec, pformat)
+        print()
 
-        print(f'', flush=True)
+    sys.stdout.flush()
 
     ax.plot_surface(X, Y, Z, rstride=1, cstride=1000, color='w', shade=True,
                     lw=.5)
@@ -1,15 +1,15 @@
 
 import argparse
-import struct
+import queue
 import sys
+import threading
 import numpy as np
 from scipy import signal
-from math import log10
-from receiver import butter_bandpass_filter, getDecimate, getNewSigRate, getFrameLength, getFrameRate
+from receiver import butter_bandpass, FirDecimator, getDecimate, getNewSigRate, getFrameLength, getFrameRate
 from tones import TonesMonitor, TonesRecord,\
     note, printHeader, printFrame, getTimestamp,\
     generateToneTemplate, DebugTonesFormat,\
-    TONES
+    ToneCorrelator, TONES
 
 def read_s16le(inp_stream, sig_rate: int):
     
@@ -17,20 +17,36 @@ def read_s16le(inp_stream, sig_rate: int):
     if not data:
         return []
     
-    int_list = []
-    idx = 0;
-    while idx < len(data):
-        
-        try:
-            two_bytes = data[idx:idx+2]
-            value = struct.unpack(f'<h', two_bytes)[0]
-            int_list.append(value)
-            idx += 2
-        except struct.error as e:
-            # Handle cases where incomplete data is read at the end
-            print(f"Warning: Incomplete 16-bit integer detected at end of input. {e}")
-            break
-    return int_list
+    if (len(data) % 2 != 0):
+        # Handle cases where incomplete data is read at the end
+        print("Warning: Incomplete 16-bit integer detected at end of input.")
+        data = data[:-1]
+
+    # Input is 16-bit, float32 is plenty and halves the memory traffic of float64
+    return np.frombuffer(data, dtype='<i2').astype(np.float32)
+
+# Producer for monitor_stream(), reads and decimates the input on its own thread so the next
+# buffer is read while the previous one is correlated. A None buffer marks the end of input,
+# an exception is passed through the queue in place of the buffer for the consumer to raise.
+def read_buffers(inp_stream, inp_sig_rate: int, decimate: int, buf_q: queue.Queue):
+    end = None
+    try:
+        if decimate > 1:
+            decimator = FirDecimator(decimate)
+
+        while (True):
+            sig_noise = read_s16le(inp_stream=inp_stream, sig_rate=inp_sig_rate)
+            if (len(sig_noise) == 0):
+                break
+
+            if decimate > 1:
+                sig_noise = decimator.process(sig_noise)
+
+            buf_q.put(sig_noise)
+    except Exception as e:
+        end = e
+    finally:
+        buf_q.put(end)
 
 def printTimestamp(format:DebugTonesFormat):
     if (format == DebugTonesFormat.DEBUG_TONES_NONE):
@@ -53,53 +69,51 @@ def monitor_stream(inp_sig_rate:int, freq_hz: int,
     frame_len = getFrameLength(inp_sig_rate)
     frame_rate = getFrameRate(inp_sig_rate)
     template = generateToneTemplate(frame_len, sig_rate)
+    correlator = ToneCorrelator(template, frame_len)
+    sos = butter_bandpass(270, 1700, sig_rate, order=8)
+    sos_zi = np.zeros((sos.shape[0], 2), dtype=np.float32)
         
     printTimestamp(pformat)
     printHeader(pformat)
     
-    tone_mon = TonesMonitor(freq_hz, selcal_log_fn)
-
-    frameCnt = 0;
-    while (True):
+    # Monitor closes its event log however the loop exits
+    with TonesMonitor(freq_hz, selcal_log_fn) as tone_mon:
 
-        sig_noise = read_s16le(inp_stream=sys.stdin.buffer, sig_rate=inp_sig_rate)
-        if (len(sig_noise) == 0):
-            break
-        
-        if decimate > 1:
-            sig_noise = signal.decimate(sig_noise, decimate)
-            
-        sig_noise = butter_bandpass_filter(sig_noise,
-                                        270,
-                                        1700,
-                                        sig_rate,
-                                        order=8)
+        # Double buffered, the reader can have up to 2 buffers ready while the current one is processed
+        buf_q = queue.Queue(maxsize=2)
+        reader = threading.Thread(target=read_buffers, args=(sys.stdin.buffer, inp_sig_rate, decimate, buf_q), daemon=True)
+        reader.start()
 
-        frames = int(len(sig_noise) / frame_len)
-        for frame in range(0, frames):
+        frameCnt = 0;
+        while (True):
 
-            beg = frame * frame_len
-            end = (frame+1) * frame_len
+            sig_noise = buf_q.get()
+            if (sig_noise is None):
+                break
+            if isinstance(sig_noise, Exception):
+                raise sig_noise
 
-            corr = np.zeros(len(TONES))
-
-            for tone in range(0, len(TONES)):
-                corr[tone] = log10(np.abs(signal.correlate(sig_noise[beg:end],
-                                                        template[tone],
-                                                        mode='same')).sum())
+            # Carry the filter state across buffers to avoid a transient at each buffer boundary
+            sig_noise, sos_zi = signal.sosfilt(sos, sig_noise, zi=sos_zi)
+        
+            frames_corr = correlator.correlateFrames(sig_noise)
+            for corr in frames_corr:
 
-            tones_rec = TonesRecord(corr)
+                tones_rec = TonesRecord(corr)
 
-            printTimestamp(pformat)
-            printFrame(frameCnt, tones_rec, pformat)
-            frameCnt += 1
+                printTimestamp(pformat)
+                printFrame(frameCnt, tones_rec, pformat)
+                frameCnt += 1
             
-            # Track Tones:
-            #  For TonesByMaxTone min_group_cnt value 3-4 is a good starting level
-            #  For TonesByScore min_score 4.5 is a good starting level 
-            selcal = tone_mon.trackTones(tones_rec, queue_window_size=frame_rate, min_group_cnt=min_group_cnt, min_score=min_score)
+                # Track Tones:
+                #  For TonesByMaxTone min_group_cnt value 3-4 is a good starting level
+                #  For TonesByScore min_score 4.5 is a good starting level 
+                selcal = tone_mon.trackTones(tones_rec, queue_window_size=frame_rate, min_group_cnt=min_group_cnt, min_score=min_score)
+
+                print(f' - Tone: {selcal["current_tgc"]} - Selcal: [{selcal["selcal"]}] (Act: {selcal["is_active"]}, Q1: {selcal["tg1"]}={selcal["tg1_cnt"]}, Q2: {selcal["tg2"]}={selcal["tg2_cnt"]}) ')
 
-            print(f' - Tone: {selcal["current_tgc"]} - Selcal: [{selcal["selcal"]}] (Act: {selcal["is_active"]}, Q1: {selcal["tg1"]}={selcal["tg1_cnt"]}, Q2: {selcal["tg2"]}={selcal["tg2_cnt"]}) ', flush=True)
+            # Flush once per buffer rather than for every frame
+            sys.stdout.flush()
 
 
 def processArgs(parser):
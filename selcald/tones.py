@@ -1,7 +1,8 @@
 
 import numpy as np
+from scipy.fft import rfft, irfft, next_fast_len
 
-from collections import deque
+from collections import Counter, deque
 from datetime import datetime, timezone
 from enum import Enum
 
@@ -40,6 +41,9 @@ ALPHABET = ['Alpha',
             'Romeo',
             'Sierra']
 
+# Tone group code digraph for each pair of tone indexes, ie DIGRAPH[0][1] = 'AB'
+DIGRAPH = [[ALPHABET[i][:1] + ALPHABET[j][:1] for j in range(0, len(ALPHABET))] for i in range(0, len(ALPHABET))]
+
 
 #####################################################################################
 # Class TonesMonitor - 
@@ -71,30 +75,30 @@ class TonesRecord:
     gtc:str=None
 
     def __init__(self, corr:list):
-        self.corr = corr
+        self.corr = np.asarray(corr, dtype=np.float64)
         self.computeStats()
 
     # Computes:
     #  - Min,Max and Average for the Corr set
     #  - Top 2 tones
     def computeStats(self):
-        max1 = 0.0
-        idx1 = -1
+        idx1 = int(np.argmax(self.corr))
+        max1 = self.corr[idx1]
+        if (max1 <= 0.0):
+            # Only a max above 0 counts (as per the original scan), ie none for digital silence
+            idx1 = -1
+            max1 = 0.0
         max2 = 0.0
         idx2 = -1
-        tot = 0.0
-        for tone in range(0, len(TONES)):
-            tot += self.corr[tone]
-            if (self.corr[tone] > max1):
-                max1 = self.corr[tone]
-                idx1 = tone       
 
+        # Scan as plain floats, the hysteresis below depends on tone order so can't be vectorised
+        corr = self.corr.tolist()
         for tone in range(0, len(TONES)):
-            if ((tone != idx1) and (self.corr[tone] > max2)):
+            if ((tone != idx1) and (corr[tone] > max2)):
                 # Only change max2 if delta its greater than that of 1/4th delta between itself and max1
                 # (ie needs to be a considerable change is max), if not stick with the first
-                if ((self.corr[tone] - max2) > ((max1 - max2) / 4)):
-                    max2 = self.corr[tone]
+                if ((corr[tone] - max2) > ((max1 - max2) / 4)):
+                    max2 = corr[tone]
                     idx2 = tone  
 
         if (idx1>idx2):
@@ -105,14 +109,11 @@ class TonesRecord:
         self.max1idx = idx1
         self.max2idx = idx2
         self.max = max1
-        self.avg = tot / len(TONES)
+        self.min = self.corr.min()
+        self.avg = self.corr.mean()
         
-        # Tone as single uppercase alphabet character
-        t1_c = ALPHABET[idx1][:1]
-        t2_c = ALPHABET[idx2][:1]
-
-        # Build the current group tone code digraph
-        self.gtc = t1_c + t2_c
+        # Current group tone code digraph
+        self.gtc = DIGRAPH[idx1][idx2]
 
         self.computeScores()
 
@@ -121,76 +122,99 @@ class TonesRecord:
         bin_score = 1 / self.score_bin_size
         bin_corr = (self.max - self.avg) / self.score_bin_size
 
-        self.scores = [0] * len(TONES)
-        for tone in range(0, len(TONES)):
-            cv = self.corr[tone]
-
-            # if cv is one of the MAX tones weight=1
-            if ((tone == self.max1idx) or (tone == self.max2idx)):
-                self.scores[tone] = 1.0
-
-            # Only score those above average, other remaining get 0
-            elif (cv > self.avg):
-                #dv = self.max - cv
-                dv = cv - self.avg
-                binIdx = int(dv / bin_corr)
-                self.scores[tone] = round(binIdx * bin_score, 1)
+        # Only score those above average, other remaining get 0
+        #  - Nothing to bin if all tones are equal or the corr set isn't finite (ie digital silence)
+        self.scores = np.zeros(len(self.corr))
+        if (np.isfinite(bin_corr) and (bin_corr > 0)):
+            above = self.corr > self.avg
+            bin_idx = np.trunc((self.corr[above] - self.avg) / bin_corr)
+            self.scores[above] = np.round(bin_idx * bin_score, 1)
+
+        # The MAX tones always weight=1, idx is -1 if no second tone was found
+        for idx in [self.max1idx, self.max2idx]:
+            if (idx >= 0):
+                self.scores[idx] = 1.0
         
         #print(f" Scores: [{self.scores}] ", end='')
 
 
 class TonesMonitor:
     # Track
-    tonesQ1 = deque()
-    tonesQ2 = deque()
-    tonesCnt1 = {}
-    tonesCnt2 = {}
+    tonesQ1:deque
+    tonesQ2:deque
+    tonesCnt1:Counter
+    tonesCnt2:Counter
 
-    tonesQ1Score = [0] * len(TONES)
-    tonesQ2Score = [0] * len(TONES)
-    tonesQ1MaxCnt = [0] * len(TONES)
-    tonesQ2MaxCnt = [0] * len(TONES)
+    tonesQ1Score:np.ndarray
+    tonesQ2Score:np.ndarray
+    tonesQ1MaxCnt:np.ndarray
+    tonesQ2MaxCnt:np.ndarray
 
-    lastSelcall = []
-    lastSelcall_BS = []
+    lastSelcall:list
+    lastSelcall_BS:list
 
     selcall_log_fn: str
+    selcall_log_fh = None
     freq_hz : int
 
     def __init__(self, freq_hz:int, selcall_log_fn: str="./selcal.log"):
         self.freq_hz = freq_hz
         self.selcall_log_fn = selcall_log_fn
 
-    def incCounter(self, tonesQ:dict, gtc:str):
-        if gtc not in tonesQ:
-            tonesQ[gtc] = 1
-        else:
-            tonesQ[gtc] += 1
+        # All tracking state is per instance, so monitors for different streams never share it
+        self.tonesQ1 = deque()
+        self.tonesQ2 = deque()
+        self.tonesCnt1 = Counter()
+        self.tonesCnt2 = Counter()
+        self.resetToneScores()
+
+        self.lastSelcall = []
+        self.lastSelcall_BS = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if (self.selcall_log_fh is not None):
+            self.selcall_log_fh.close()
+            self.selcall_log_fh = None
 
-    def decCounter(self, tonesQ:dict, gtc:str):
+    # Log is opened on the first event and then stays open for the life of the monitor,
+    # line buffered so each event is written out immediately
+    def logEvent(self, event:str):
+        if (self.selcall_log_fh is None):
+            self.selcall_log_fh = open(self.selcall_log_fn, "a", buffering=1)
+
+        self.selcall_log_fh.write(event)
+
+    def incCounter(self, tonesQ:Counter, gtc:str):
+        tonesQ[gtc] += 1
+
+    def decCounter(self, tonesQ:Counter, gtc:str):
         if gtc in tonesQ:
             tonesQ[gtc] -= 1
 
     def resetToneScores(self):
-        self.tonesQ1Score = [0] * len(TONES)
-        self.tonesQ2Score = [0] * len(TONES)
-        self.tonesQ1MaxCnt = [0] * len(TONES)
-        self.tonesQ1MaxCnt = [0] * len(TONES)
+        self.tonesQ1Score = np.zeros(len(TONES))
+        self.tonesQ2Score = np.zeros(len(TONES))
+        self.tonesQ1MaxCnt = np.zeros(len(TONES), dtype=int)
+        self.tonesQ2MaxCnt = np.zeros(len(TONES), dtype=int)
 
-    def incScores(self, toneQScores:list, tonesQMaxCnt:list, trec:TonesRecord):
-        for tone in range(0, len(TONES)):
-            toneQScores[tone] += trec.scores[tone]
+    # Max tone indexes to count for the record, idx is -1 if no tone was found (as per computeScores)
+    def maxToneIdxs(self, trec:TonesRecord):
+        return [idx for idx in [trec.max1idx, trec.max2idx] if (idx >= 0)]
 
-        tonesQMaxCnt[trec.max1idx] += 1
-        tonesQMaxCnt[trec.max2idx] += 1
+    def incScores(self, toneQScores:np.ndarray, tonesQMaxCnt:np.ndarray, trec:TonesRecord):
+        toneQScores += trec.scores
+        np.add.at(tonesQMaxCnt, self.maxToneIdxs(trec), 1)
 
-    def decScores(self, toneQScores:list,  tonesQMaxCnt:list, trec:TonesRecord):
-        for tone in range(0, len(TONES)):
-            if (toneQScores[tone] > 0):
-                toneQScores[tone] -= trec.scores[tone]
-            
-        tonesQMaxCnt[trec.max1idx] += 1
-        tonesQMaxCnt[trec.max2idx] += 1                
+    def decScores(self, toneQScores:np.ndarray,  tonesQMaxCnt:np.ndarray, trec:TonesRecord):
+        # Only reduce the scores still above zero
+        toneQScores -= np.where(toneQScores > 0, trec.scores, 0.0)
+        np.subtract.at(tonesQMaxCnt, self.maxToneIdxs(trec), 1)
 
     def trackByMaxTones(self, trec:TonesRecord, queue_window_size:int, min_group_cnt:int, res:dict):
         q1_max_tgc = None
@@ -223,19 +247,19 @@ class TonesMonitor:
                 self.decCounter(self.tonesCnt1, last_gtcQ1)
                 self.decScores(self.tonesQ1Score, self.tonesQ1MaxCnt, last_trecQ1)
 
-        # Lets scan the sliding windows and determine the TGC with highest cnt in each half
-        for q2_tgc in self.tonesCnt2.keys():
-            cnt = self.tonesCnt2[q2_tgc]
-            if (cnt > q2_max_tgc_cnt):
+        # Lets determine the TGC with highest cnt in each half of the sliding windows
+        #  - most_common() is ordered by cnt, ties keep the first encountered TGC
+        for q2_tgc, cnt in self.tonesCnt2.most_common(1):
+            if (cnt > 0):
                 q2_max_tgc = q2_tgc
                 q2_max_tgc_cnt = cnt
 
-        for q1_tgc in self.tonesCnt1.keys():
-            cnt = self.tonesCnt1[q1_tgc]
+        for q1_tgc, cnt in self.tonesCnt1.most_common(2):
             # Only cnt in max logic if not the same code from Q2
-            if (q1_tgc != q2_max_tgc) and (cnt > q1_max_tgc_cnt):
+            if (q1_tgc != q2_max_tgc) and (cnt > 0):
                 q1_max_tgc = q1_tgc
                 q1_max_tgc_cnt = cnt
+                break
                 
         # Have we encounter active selcall ? 
         if ((q1_max_tgc_cnt >= min_group_cnt) and
@@ -250,7 +274,7 @@ class TonesMonitor:
 
                 # log selcal event
                 selcall_event = f"{getTimestamp()} {self.freq_hz/1000:.01f} kHz {res['selcal']} ~ SELCAL_BYMAXTONE\n"
-                writeStringToFile(self.selcall_log_fn, selcall_event)
+                self.logEvent(selcall_event)
 
         else:
             res['is_active'] = False
@@ -258,8 +282,8 @@ class TonesMonitor:
 
             # Looks like end of prev selcall, Clear both all counters
             if (len(self.lastSelcall) > 0):                
-                self.tonesCnt1 = {}
-                self.tonesCnt2 = {}
+                self.tonesCnt1 = Counter()
+                self.tonesCnt2 = Counter()
 
                 self.lastSelcall = []
         
@@ -304,8 +328,8 @@ class TonesMonitor:
                 (q1Max2idx != q2Max1idx) and
                 (q1Max2idx != q2Max2idx)):
 
-                q1_score_tgc = ALPHABET[top2Q1["idx"][0]][:1] + ALPHABET[top2Q1["idx"][1]][:1]
-                q2_score_tgc = ALPHABET[top2Q2["idx"][0]][:1] + ALPHABET[top2Q2["idx"][1]][:1]
+                q1_score_tgc = DIGRAPH[q1Max1idx][q1Max2idx]
+                q2_score_tgc = DIGRAPH[q2Max1idx][q2Max2idx]
 
                 res['is_active_BS'] = True
                 res['selcal_BS'] = f"{q1_score_tgc}-{q2_score_tgc}"
@@ -319,7 +343,7 @@ class TonesMonitor:
                     # log selcal event
                     stats = f" [ Score: (Q1: {q1Max1idx}:{q1Max1Val:.01f}, {q1Max2idx}:{q1Max2Val:.01f})  Q2: ({q2Max1idx}:{q2Max1Val:.01f}, {q2Max2idx}:{q2Max2Val:.01f}) ] "
                     selcall_event = f"{getTimestamp()} {self.freq_hz/1000:.01f} kHz {selcal_byscore} ~ SELCAL_BYSCORE - STATS: [{stats}]\n"
-                    writeStringToFile(self.selcall_log_fn, selcall_event)                   
+                    self.logEvent(selcall_event)
 
         else:
             
@@ -361,16 +385,6 @@ def getTimestamp():
     return ts.strftime("%Y/%m/%d-%H:%M:%S")
     
 
-def writeStringToFile(out_fn: str, item: str, append: bool=True):
-    wmode = "w"
-    if append:
-        wmode ="a"
-
-    with open(out_fn, wmode) as file:                    
-        file.write(item)
-
-    return 0
-
 class DebugTonesFormat(Enum):
     DEBUG_TONES_NONE = 0
     DEBUG_TONES_COMPACT = 1
@@ -387,12 +401,66 @@ def note(freq, cycles, amp=32767.0, rate=44100):
         data = np.sin(2 * np.pi * freq * t) * amp
     return data.astype(int)
 
-def generateToneTemplate(frame_len: int, sig_rate: int):
-    template = []
-    for tone in range(0, len(TONES)):
-        template.append(note(TONES[tone], frame_len, rate=sig_rate))
+# Templates are returned as one contiguous (tones, frame_len) float32 matrix, one row per tone
+def generateToneTemplate(frame_len: int, sig_rate: int, amp=32767.0):
+    # Same time base as note(), min_score in trackByScore() is tuned against these templates
+    t = np.linspace(0, frame_len * (1.0/sig_rate), frame_len)
+    freqs = np.asarray(TONES)[:, None]
+
+    return (np.sin(2 * np.pi * freqs * t) * amp).astype(np.float32)
+
+#####################################################################################
+# Class ToneCorrelator -
+#   - Cross-correlates frames against all the tone templates in one pass using the
+#     identity xcorr(d,t) = ifft(fft(d) * conj(fft(t))). The template FFTs are computed
+#     once up front, so a buffer of frames only costs a batched forward FFT and a batched
+#     inverse across every (frame, tone) pair.
+#   - Only the lags signal.correlate(mode='same') would return are summed, so the
+#     resulting log correlation values match the original time-domain implementation.
+#####################################################################################
+
+class ToneCorrelator:
+
+    frame_len:int
+    nfft:int
+    template_fft:np.ndarray
+    lag_neg:int
+    lag_pos:int
+
+    def __init__(self, template:np.ndarray, frame_len:int):
+        template = np.asarray(template, dtype=np.float32)
+        tmpl_len = template.shape[1]
 
-    return template
+        # FFT length must cover the full linear correlation to avoid circular wrap around,
+        # next_fast_len rounds up to a 2,3,5-smooth size rather than the next power of 2
+        self.frame_len = frame_len
+        self.nfft = next_fast_len(frame_len + tmpl_len - 1, real=True)
+        self.template_fft = rfft(template, n=self.nfft, axis=1).conj()
+
+        # 'same' lags run from -lag_neg to lag_pos, negative lags wrap to the end of the IFFT output
+        self.lag_neg = (tmpl_len - 1) - (tmpl_len - 1) // 2
+        self.lag_pos = frame_len - self.lag_neg
+
+    def correlate(self, frame:np.ndarray):
+        return self.correlateFrames(frame)[0]
+
+    # Correlates every whole frame in the buffer against all tones in one batched FFT pass,
+    # returns log correlation values shaped (frames, tones)
+    def correlateFrames(self, sig:np.ndarray):
+        frames = int(len(sig) / self.frame_len)
+        frames_mat = np.reshape(sig[:frames * self.frame_len], (frames, self.frame_len))
+
+        frames_fft = rfft(frames_mat, n=self.nfft, axis=1, workers=-1)
+        corr_full = irfft(frames_fft[:, None, :] * self.template_fft[None, :, :], n=self.nfft, axis=2, workers=-1)
+
+        # Take abs in place and reduce straight off the IFFT output, no temporary correlation arrays
+        np.abs(corr_full, out=corr_full)
+        corr_sum = np.add.reduce(corr_full[:, :, :self.lag_pos], axis=2)
+        corr_sum += np.add.reduce(corr_full[:, :, self.nfft - self.lag_neg:], axis=2)
+
+        # Digital silence gives a 0 sum, let that be -inf without a warning on every silent buffer
+        with np.errstate(divide='ignore'):
+            return np.log10(corr_sum, out=corr_sum)
 
 def printHeader(format:DebugTonesFormat):
     if (format == DebugTonesFormat.DEBUG_TONES_NONE):
@@ -408,73 +476,55 @@ def printHeader(format:DebugTonesFormat):
         print('      S     Avg')
 
 
-def printSymbol(sym, format:DebugTonesFormat):
+def formatSymbol(sym, format:DebugTonesFormat):
     pad = ""
     if (format in [DebugTonesFormat.DEBUG_TONES_MAX_AND_ABOVE_AVG, DebugTonesFormat.DEBUG_TONES_MAX_ONLY]):
         pad = "  "
 
-    print(f" {pad}{sym}{pad} ", end='')
+    return f" {pad}{sym}{pad} "
 
 
-def printValue(val_type, val, format:DebugTonesFormat):
+def formatValue(val_type, val, format:DebugTonesFormat):
     if (val_type == "MAX"):
         if ((format in [DebugTonesFormat.DEBUG_TONES_MAX_AND_ABOVE_AVG, DebugTonesFormat.DEBUG_TONES_MAX_ONLY])):
-            print(f"[{val:5.02f}]", end='')
+            return f"[{val:5.02f}]"
         else:
-            printSymbol("|", format)
+            return formatSymbol("|", format)
 
     elif (val_type == "AVG") :
         if ((format in [DebugTonesFormat.DEBUG_TONES_MAX_AND_ABOVE_AVG])):
-            print(f" {val:5.02f} ", end='')
+            return f" {val:5.02f} "
         else:
-            printSymbol("+", format)
+            return formatSymbol("+", format)
     
     else:
-        printSymbol(".", format)
+        return formatSymbol(".", format)
 
 
+# Frame is built up as a single string and written with one print call
 def printFrame(frame:int, trec:TonesRecord, format:DebugTonesFormat):
     if (format == DebugTonesFormat.DEBUG_TONES_NONE):
         return
     
-    print(f'{frame:06d}: ', end='')
+    line = [f'{frame:06d}: ']
     for tone in range(0, len(TONES)):
         if tone == trec.max1idx or tone == trec.max2idx:                        
-            printValue("MAX", trec.corr[tone], format)
+            line.append(formatValue("MAX", trec.corr[tone], format))
         else:
             if trec.corr[tone] > trec.avg:
-                printValue("AVG", trec.corr[tone], format)
+                line.append(formatValue("AVG", trec.corr[tone], format))
             else:
-                printValue("<=AVG", trec.corr[tone], format)
+                line.append(formatValue("<=AVG", trec.corr[tone], format))
     
-    print(f' {trec.avg:5.02f}', end='')
+    line.append(f' {trec.avg:5.02f}')
+    print(''.join(line), end='')
 
 
 def top2(vals:list, excluded_idx:list=[]):
-    idx1 = -1
-    max1 = -1
-    idx2 = -1
-    max2 = -1
-    for tone in range(0, len(vals)):
-        if (tone in excluded_idx):
-            continue
-
-        if vals[tone] > max1:
-            if (idx1 >= 0):
-                max2=max1
-                idx2=idx1
-
-            max1 = vals[tone]
-            idx1 = tone           
-
-        elif vals[tone] > max2:
-            max2 = vals[tone]
-            idx2 = tone      
-
-    # Ensure order of indexes from smalled to large (NOT value, just index)
-    if (idx1>idx2):
-        t = idx1
-        idx1 = idx2
-        idx2 = t
-
-    return {"idx": [idx1, idx2], "val": [vals[idx1], vals[idx2]]}
+    arr = np.array(vals, dtype=np.float64)
+    arr[excluded_idx] = -np.inf
+
+    # Stable sort so ties go to the lowest tone index, then order indexes from small to large (NOT value, just index)
+    idx = np.sort(np.argsort(-arr, kind='stable')[:2])
+
+    return {"idx": idx.tolist(), "val": arr[idx].tolist()}